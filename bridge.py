@@ -1,11 +1,20 @@
 #!/usr/bin/env python3
 import os
 import time
-import json
+import gzip
+import hashlib
 import logging
-from urllib.request import urlopen
+import socket
+import threading
+from collections import deque
+from http.client import HTTPConnection, HTTPSConnection
+from urllib.parse import urlsplit
+import orjson
 import paho.mqtt.client as mqtt
 
+# Map IPv4 dots and IPv6 colons to '_' and drop IPv6 brackets in one pass
+_IP_ID_TRANS = str.maketrans('.:', '__', '[]')
+
 
 class Go2RtcClient:
     """Fetches data from go2rtc API."""
@@ -14,15 +23,55 @@ class Go2RtcClient:
         self.api_url = api_url
         self.logger = logging.getLogger(__name__)
 
+        url = urlsplit(api_url)
+        self._conn_class = HTTPSConnection if url.scheme == 'https' else HTTPConnection
+        self._netloc = url.netloc
+        self._path = f"{url.path or '/'}?{url.query}" if url.query else (url.path or '/')
+        self._conn = None
+        self._last_digest = None
+
     def fetch_streams(self):
-        """Fetch stream data from go2rtc API."""
+        """Fetch stream data from go2rtc API. Returns None if unchanged since the last fetch."""
         try:
-            with urlopen(self.api_url, timeout=10) as resp:
-                return json.loads(resp.read())
+            try:
+                body = self._get()
+            except ConnectionError:
+                # Server closed the idle keep-alive connection; retry once on a fresh one
+                self._close()
+                body = self._get()
+
+            digest = hashlib.blake2b(body, digest_size=8).digest()
+            if digest == self._last_digest:
+                return None
+            streams = orjson.loads(body)
+            self._last_digest = digest
+            return streams
         except Exception as e:
+            self._close()
+            self._last_digest = None
             self.logger.error(f"API fetch failed: {e}")
             return {}
 
+    def _get(self):
+        """GET the API path over the persistent connection. Returns raw body."""
+        if self._conn is None:
+            self._conn = self._conn_class(self._netloc, timeout=10)
+
+        self._conn.request('GET', self._path, headers={'Accept-Encoding': 'gzip'})
+        resp = self._conn.getresponse()
+        body = resp.read()
+        if resp.status != 200:
+            raise RuntimeError(f"HTTP {resp.status} {resp.reason}")
+        if resp.getheader('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def _close(self):
+        """Drop the persistent connection so the next request reconnects."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
 
 class TabletExtractor:
     """Extracts tablet data from go2rtc streams."""
@@ -30,28 +79,32 @@ class TabletExtractor:
     @staticmethod
     def extract_ip(remote_addr):
         """Extract IP from remote_addr (e.g., '192.168.50.67:1234' -> '192.168.50.67')."""
-        return remote_addr.split(':')[0] if remote_addr else None
+        return remote_addr.rsplit(':', 1)[0] if remote_addr else None
 
-    @staticmethod
-    def extract_tablets(streams):
+    def __init__(self):
+        self._stream_names = None
+        self._tablet_stream_names = []
+
+    def extract_tablets(self, streams):
         """Group consumers by tablet IP across all *_tablet streams."""
         tablets = {}
 
-        for stream_name, stream_data in streams.items():
-            if not stream_name.endswith('_tablet'):
-                continue
+        # The stream list rarely changes, so only re-filter it when it does
+        if streams.keys() != self._stream_names:
+            self._stream_names = set(streams)
+            self._tablet_stream_names = [name for name in streams if name.endswith('_tablet')]
 
+        for stream_name in self._tablet_stream_names:
+            stream_data = streams[stream_name]
             producer = stream_data.get('producers', [{}])[0]
 
             for consumer in stream_data.get('consumers', []):
-                ip = TabletExtractor.extract_ip(consumer.get('remote_addr', ''))
+                ip = self.extract_ip(consumer.get('remote_addr', ''))
                 if not ip:
                     continue
 
-                if ip not in tablets:
-                    tablets[ip] = {'user_agent': consumer.get('user_agent', ''), 'streams': {}}
-
-                tablets[ip]['streams'][stream_name] = {
+                tablet = tablets.setdefault(ip, {'user_agent': consumer.get('user_agent', ''), 'streams': {}})
+                tablet['streams'][stream_name] = {
                     'source': producer.get('source', producer.get('url', '')),
                     'format_name': consumer.get('format_name', ''),
                     'bytes_send': consumer.get('bytes_send', 0)
@@ -61,71 +114,123 @@ class TabletExtractor:
 
 
 class MbpsCalculator:
-    """Calculates bandwidth (Mbps) from bytes sent."""
+    """Calculates bandwidth (Mbps) from bytes sent, averaged over the last few samples."""
 
-    def __init__(self, poll_interval):
-        self.poll_interval = poll_interval
-        self.previous_bytes = {}
+    def __init__(self, window=3):
+        self.window = window
+        self.history = {}
 
     def calculate(self, key, current_bytes):
-        """Calculate Mbps for given key. Returns 0 on first call."""
-        if key not in self.previous_bytes:
-            self.previous_bytes[key] = current_bytes
-            return 0
+        """Calculate Mbps for given key as a '.2f' string. Returns "0.00" on first call."""
+        history = self.history.get(key)
+        if history is None:
+            history = self.history[key] = deque(maxlen=self.window)
+        elif history and current_bytes < history[-1][1]:
+            # Counter reset (consumer reconnected): restart the window instead of going negative
+            history.clear()
+        history.append((time.monotonic(), current_bytes))
+
+        if len(history) < 2:
+            mbps = "0.00"
+        else:
+            first_time, first_bytes = history[0]
+            last_time, last_bytes = history[-1]
+            mbps = f"{((last_bytes - first_bytes) * 8) / ((last_time - first_time) * 1_000_000):.2f}"
+
+        return mbps
+
+
+def _on_connect(client, publisher, flags, rc):
+    """Log connection result and release anyone waiting for the first connect."""
+    logging.getLogger(__name__).info("MQTT connected rc=%d", rc)
+    if rc == 0:
+        publisher.connect_count += 1
+        publisher.connected.set()
 
-        bytes_diff = current_bytes - self.previous_bytes[key]
-        self.previous_bytes[key] = current_bytes
-        return round((bytes_diff * 8) / (self.poll_interval * 1_000_000), 2)
+
+def _on_socket_open(client, publisher, sock):
+    """Enlarge the send buffer so a burst of discovery publishes doesn't stall on backpressure."""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
 
 
 class MqttPublisher:
     """Handles MQTT publishing."""
 
-    def __init__(self, broker, port, username='', password=''):
-        self.client = mqtt.Client()
+    def __init__(self, broker, port, username='', password='', client_id=''):
+        self.logger = logging.getLogger(__name__)
+        self.client = mqtt.Client(client_id=client_id, userdata=self)
         if username:
             self.client.username_pw_set(username, password)
-        self.client.on_connect = lambda c, u, f, rc: logging.info(f"MQTT connected: {rc}")
-        self.client.connect(broker, port)
+        self.client.on_connect = _on_connect
+        self.client.on_socket_open = _on_socket_open
+        self.client.max_inflight_messages_set(200)
+        self.client.max_queued_messages_set(0)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.connected = threading.Event()
+        self.connect_count = 0
+        self.client.connect_async(broker, port)
         self.client.loop_start()
 
-    def publish(self, topic, payload):
-        """Publish message to MQTT topic."""
-        logging.info(f"Publishing to topic: {topic}")
-        self.client.publish(topic, payload, qos=1, retain=True)
+    def wait_connected(self, timeout):
+        """Block until connected to the broker. Returns False on timeout."""
+        return self.connected.wait(timeout)
+
+    def publish_many(self, messages):
+        """Publish a batch of message dicts (topic, payload, qos, retain) in one burst."""
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        for msg in messages:
+            if debug:
+                self.logger.debug("Publishing to topic: %s", msg['topic'])
+            self.client.publish(msg['topic'], msg['payload'], qos=msg['qos'], retain=msg['retain'])
 
 
 class HADiscoveryPublisher:
-    """Publishes Home Assistant MQTT discovery configs."""
+    """Builds Home Assistant MQTT discovery messages."""
 
-    def __init__(self, mqtt_publisher, ha_prefix, mqtt_topic):
-        self.mqtt = mqtt_publisher
+    def __init__(self, ha_prefix, mqtt_topic):
         self.ha_prefix = ha_prefix
         self.mqtt_topic = mqtt_topic
-        self.published = set()
+        self.published = {}
+        self._device_prefix = f"{ha_prefix}/device/go2rtc_"
 
-    def publish_sensor(self, device_id, entity_id, name, state_topic, device, unit=None):
-        """Publish single sensor discovery config."""
-        unique_key = f"{device_id}_{entity_id}"
-        if unique_key in self.published:
-            return
+    def reset(self):
+        """Forget which device configs were sent so they are republished."""
+        self.published.clear()
 
+    def sensor_config(self, device_id, entity_id, name, state_topic, unit=None):
+        """Create discovery config for one sensor component of a device."""
         config = {
+            'platform': 'sensor',
             'name': name,
             'unique_id': f"go2rtc_{device_id}_{entity_id}",
-            'state_topic': state_topic,
-            'device': device
+            'state_topic': state_topic
         }
         if unit:
             config['unit_of_measurement'] = unit
+        return config
 
-        topic = f"{self.ha_prefix}/sensor/go2rtc_{device_id}/{entity_id}/config"
-        self.mqtt.publish(topic, json.dumps(config))
-        self.published.add(unique_key)
+    def device_message(self, device_id, device, components):
+        """Create device discovery message with all its components. Returns None if unchanged."""
+        if self.published.get(device_id) == components.keys():
+            return None
+
+        config = {
+            'device': device,
+            'origin': {'name': 'go2rtc-mqtt-bridge'},
+            'components': components
+        }
+
+        self.published[device_id] = set(components)
+        return {
+            'topic': self._device_prefix + device_id + '/config',
+            'payload': orjson.dumps(config),
+            'qos': 1,
+            'retain': True
+        }
 
     def create_device_config(self, ip):
         """Create HA device config for a tablet."""
-        device_id = f"tablet_{ip.replace('.', '_')}"
+        device_id = f"tablet_{ip.translate(_IP_ID_TRANS)}"
         return {
             'identifiers': [f"go2rtc_{device_id}"],
             'name': f"Tablet {ip}",
@@ -137,58 +242,125 @@ class HADiscoveryPublisher:
 class TabletPublisher:
     """Publishes tablet data to MQTT."""
 
-    def __init__(self, mqtt_publisher, ha_publisher, mqtt_topic, mbps_calc):
-        self.mqtt = mqtt_publisher
+    # Live counters: published every poll without retain so late subscribers still get them
+    TELEMETRY_FIELDS = ('bytes_send', 'mbps')
+
+    def __init__(self, ha_publisher, mqtt_topic, mbps_calc):
         self.ha = ha_publisher
         self.mqtt_topic = mqtt_topic
         self.mbps_calc = mbps_calc
+        self._last_state = {}
+        self._pending = []
+        self._tablet_cache = {}
 
-    def publish(self, ip, tablet_data):
-        """Publish all data for one tablet."""
-        device_id = f"tablet_{ip.replace('.', '_')}"
-        base_topic = f"{self.mqtt_topic}/{device_id}"
-        device = self.ha.create_device_config(ip)
-
-        self._publish_user_agent(device_id, base_topic, device, tablet_data['user_agent'])
-        self._publish_streams(ip, device_id, base_topic, device, tablet_data['streams'])
+    def reset(self):
+        """Forget what has been sent so the next poll republishes discovery and state."""
+        self._last_state.clear()
+        self.ha.reset()
 
-    def _publish_user_agent(self, device_id, base_topic, device, user_agent):
+    def publish(self, ip, tablet_data):
+        """Collect discovery and state messages for one tablet. Returns list of message dicts."""
+        self._pending = []
+        tablet = self._tablet(ip)
+
+        self._publish_user_agent(tablet, tablet_data['user_agent'])
+        self._publish_streams(ip, tablet, tablet_data['streams'])
+
+        # Discovery goes first so HA is subscribed before the state arrives
+        discovery = self.ha.device_message(tablet['device_id'], tablet['device'], tablet['components'])
+        if discovery:
+            self._pending.insert(0, discovery)
+        return self._pending
+
+    def publish_telemetry(self, ip, tablet_data):
+        """Collect only bytes_send and Mbps messages for one tablet. Returns list of message dicts."""
+        self._pending = []
+        tablet = self._tablet(ip)
+
+        for stream_name, stream_info in tablet_data['streams'].items():
+            self._publish_field(tablet, stream_name, 'bytes_send', stream_info['bytes_send'])
+            self._publish_mbps(ip, tablet, stream_name, stream_info['bytes_send'])
+        return self._pending
+
+    def _tablet(self, ip):
+        """Return cached device id, base topic, device config and sensors for a tablet."""
+        tablet = self._tablet_cache.get(ip)
+        if tablet is None:
+            device_id = f"tablet_{ip.translate(_IP_ID_TRANS)}"
+            base_topic = f"{self.mqtt_topic}/{device_id}"
+            tablet = {
+                'device_id': device_id,
+                'base_topic': base_topic,
+                'device': self.ha.create_device_config(ip),
+                'sensors': {},
+                'components': {}
+            }
+            self._add_sensor(tablet, 'user_agent', 'user_agent', 'User Agent',
+                             f"{base_topic}/user_agent")
+            self._tablet_cache[ip] = tablet
+        return tablet
+
+    def _sensor(self, tablet, stream_name, field, unit=None):
+        """Return cached state topic for a stream field, registering its sensor on first use."""
+        key = (stream_name, field)
+        state_topic = tablet['sensors'].get(key)
+        if state_topic is None:
+            state_topic = self._add_sensor(tablet, key, f"{stream_name}_{field}",
+                                           f"{stream_name} {field.replace('_', ' ').title()}",
+                                           f"{tablet['base_topic']}/{stream_name}/{field}", unit)
+            if field in self.TELEMETRY_FIELDS:
+                # Clear any value an older version left retained before going non-retained
+                self._queue(state_topic, '', retain=True)
+        return state_topic
+
+    def _add_sensor(self, tablet, key, entity_id, name, state_topic, unit=None):
+        """Cache a sensor's state topic and add its discovery component to the tablet."""
+        tablet['sensors'][key] = state_topic
+        tablet['components'][entity_id] = self.ha.sensor_config(
+            tablet['device_id'], entity_id, name, state_topic, unit)
+        return state_topic
+
+    def _publish_user_agent(self, tablet, user_agent):
         """Publish user agent sensor."""
-        self.ha.publish_sensor(device_id, 'user_agent', 'User Agent',
-                               f"{base_topic}/user_agent", device)
-        self.mqtt.publish(f"{base_topic}/user_agent", user_agent)
+        self._publish_if_changed(tablet['sensors']['user_agent'], user_agent)
 
-    def _publish_streams(self, ip, device_id, base_topic, device, streams):
+    def _publish_streams(self, ip, tablet, streams):
         """Publish all stream sensors for a tablet."""
         for stream_name, stream_info in streams.items():
-            self._publish_stream(ip, device_id, base_topic, device, stream_name, stream_info)
+            self._publish_stream(ip, tablet, stream_name, stream_info)
 
-    def _publish_stream(self, ip, device_id, base_topic, device, stream_name, stream_info):
+    def _publish_stream(self, ip, tablet, stream_name, stream_info):
         """Publish sensors for a single stream."""
         for field in ['source', 'format_name', 'bytes_send']:
-            self._publish_field(device_id, base_topic, device, stream_name, field, stream_info[field])
+            self._publish_field(tablet, stream_name, field, stream_info[field])
 
-        self._publish_mbps(ip, device_id, base_topic, device, stream_name, stream_info['bytes_send'])
+        self._publish_mbps(ip, tablet, stream_name, stream_info['bytes_send'])
 
-    def _publish_field(self, device_id, base_topic, device, stream_name, field, value):
+    def _publish_field(self, tablet, stream_name, field, value):
         """Publish a single field sensor."""
-        entity_id = f"{stream_name}_{field}"
-        name = f"{stream_name} {field.replace('_', ' ').title()}"
-        state_topic = f"{base_topic}/{stream_name}/{field}"
-
-        self.ha.publish_sensor(device_id, entity_id, name, state_topic, device)
-        self.mqtt.publish(state_topic, str(value))
+        state_topic = self._sensor(tablet, stream_name, field)
+        if field in self.TELEMETRY_FIELDS:
+            self._queue(state_topic, str(value), retain=False)
+        else:
+            self._publish_if_changed(state_topic, str(value))
 
-    def _publish_mbps(self, ip, device_id, base_topic, device, stream_name, bytes_send):
+    def _publish_mbps(self, ip, tablet, stream_name, bytes_send):
         """Publish Mbps sensor."""
-        entity_id = f"{stream_name}_mbps"
-        state_topic = f"{base_topic}/{stream_name}/mbps"
+        state_topic = self._sensor(tablet, stream_name, 'mbps', unit='Mbps')
 
-        mbps = self.mbps_calc.calculate(f"{ip}_{stream_name}", bytes_send)
+        mbps = self.mbps_calc.calculate((ip, stream_name), bytes_send)
+        self._queue(state_topic, mbps, retain=False)
 
-        self.ha.publish_sensor(device_id, entity_id, f"{stream_name} Mbps",
-                               state_topic, device, unit='Mbps')
-        self.mqtt.publish(state_topic, str(mbps))
+    def _publish_if_changed(self, topic, payload, retain=True):
+        """Publish state only if it differs from the last value sent to this topic."""
+        if self._last_state.get(topic) == payload:
+            return
+        self._queue(topic, payload, retain)
+        self._last_state[topic] = payload
+
+    def _queue(self, topic, payload, retain):
+        """Queue a QoS 0 state message for this poll's batch."""
+        self._pending.append({'topic': topic, 'payload': payload, 'qos': 0, 'retain': retain})
 
 
 class Bridge:
@@ -202,42 +374,69 @@ class Bridge:
 
         self.client = Go2RtcClient(os.getenv('GO2RTC_API_URL', 'http://192.168.50.8:1984/api/streams'))
         self.extractor = TabletExtractor()
-        self.mbps_calc = MbpsCalculator(poll_interval)
+        self.mbps_calc = MbpsCalculator()
 
         mqtt_pub = MqttPublisher(
             os.getenv('MQTT_BROKER', 'localhost'),
             int(os.getenv('MQTT_PORT', '1883')),
             os.getenv('MQTT_USER', ''),
-            os.getenv('MQTT_PASS', '')
+            os.getenv('MQTT_PASS', ''),
+            os.getenv('MQTT_CLIENT_ID', '')
         )
 
         ha_pub = HADiscoveryPublisher(
-            mqtt_pub,
             os.getenv('HA_DISCOVERY_PREFIX', 'homeassistant'),
             os.getenv('MQTT_TOPIC', 'go2rtc/tablets')
         )
 
-        self.publisher = TabletPublisher(mqtt_pub, ha_pub,
+        self.publisher = TabletPublisher(ha_pub,
                                          os.getenv('MQTT_TOPIC', 'go2rtc/tablets'),
                                          self.mbps_calc)
+        self.mqtt = mqtt_pub
         self.poll_interval = poll_interval
 
     def run(self):
         """Main loop."""
-        time.sleep(1)  # Wait for MQTT connection
+        if not self.mqtt.wait_connected(timeout=10):
+            self.logger.warning("MQTT not connected yet, continuing to poll")
         self.logger.info(f"Bridge started, polling every {self.poll_interval}s")
 
+        connect_count = self.mqtt.connect_count
+        tablets = {}
+        next_poll = time.monotonic()
         while True:
-            streams = self.client.fetch_streams()
-            tablets = self.extractor.extract_tablets(streams)
+            full_publish = False
 
-            for ip, tablet_data in tablets.items():
-                self.publisher.publish(ip, tablet_data)
+            # State published while disconnected was dropped; resend everything after a reconnect
+            if self.mqtt.connect_count != connect_count:
+                connect_count = self.mqtt.connect_count
+                self.publisher.reset()
+                full_publish = True
 
-            if tablets:
-                self.logger.info(f"Published {len(tablets)} tablets")
+            streams = self.client.fetch_streams()
+            if streams is not None:
+                tablets = self.extractor.extract_tablets(streams)
+                full_publish = True
 
-            time.sleep(self.poll_interval)
+            # An identical API response only needs telemetry refreshed; everything else is unchanged
+            messages = []
+            for ip, tablet_data in tablets.items():
+                if full_publish:
+                    messages.extend(self.publisher.publish(ip, tablet_data))
+                else:
+                    messages.extend(self.publisher.publish_telemetry(ip, tablet_data))
+            self.mqtt.publish_many(messages)
+
+            if messages:
+                self.logger.info(f"Published {len(messages)} messages for {len(tablets)} tablets")
+
+            # Schedule against a fixed deadline so work time doesn't accumulate as drift
+            next_poll += self.poll_interval
+            delay = next_poll - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_poll = time.monotonic()
 
 
 if __name__ == '__main__':